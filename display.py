@@ -1,14 +1,15 @@
 import asyncio
-import itertools
+import bisect
+import functools
 import os
-from datetime import datetime
-from typing import Literal, Optional
+import time
+from typing import TYPE_CHECKING, Literal, Optional
 
-import pytz
-import requests
+import aiohttp
+from google.protobuf.message import DecodeError
 from google.transit import gtfs_realtime_pb2
 
-from PIL import Image
+from PIL import Image, ImageDraw, ImageFont
 
 try:
     from rgbmatrix import RGBMatrix, RGBMatrixOptions, graphics
@@ -16,8 +17,22 @@ except ImportError:
     # Assume we're trying to emulate
     from RGBMatrixEmulator import RGBMatrix, RGBMatrixOptions, graphics
 
+if TYPE_CHECKING:
+    from rgbmatrix import FrameCanvas
+
 # Need to do an `Image.open` early, else PIL fails on "Cannot identify image file" :\
-A_TRAIN_IMAGE = Image.open('./img/a_train.png').convert('RGB')
+# Decoding every icon up front also saves re-reading them from disk on each render.
+ICONS = {
+    name: Image.open(f'./img/{name}.png').convert('RGB')
+    for name in ('a_train', 'clouds', 'rain', 'clear', 'snow')
+}
+
+FONT = graphics.Font()
+FONT.LoadFont('./fonts/6x10.bdf')
+
+# The same font for PIL, to compose text into images. Generated from the BDF with
+# `BdfFontFile.BdfFontFile(open('./fonts/6x10.bdf', 'rb')).save('./fonts/6x10')`.
+PIL_FONT = ImageFont.load('./fonts/6x10.pil')
 
 # Update every x seconds
 DISPLAY_UPDATE_SECONDS = 30
@@ -27,6 +42,10 @@ WEATHER_UPDATE_SECONDS = 300
 ROWS = 32
 COLS = 64
 
+# The weather row spans the height of the font, with text on the same baseline as FONT's y=18
+WEATHER_ROW_Y = 10
+WEATHER_ROW_HEIGHT = 10
+
 COLOUR_YELLOW = graphics.Color(255, 255, 0)
 COLOUR_LIGHT_GRAY = graphics.Color(211, 211, 211)
 COLOUR_LIGHT_BLUE = graphics.Color(204, 255, 255)
@@ -34,211 +53,266 @@ COLOUR_LIGHT_ORANGE = graphics.Color(255, 229, 204)
 COLOUR_GREEN = graphics.Color(64, 255, 0)
 
 HOYT_SCHER_NORTH_STOP = "A42N"
-HOYT_SCHER_SOUTH_STOP = "A42S"
-
-EASTERN_TZ = pytz.timezone('US/Eastern')
 
 
 WeatherStatus = Literal["Clouds", "Rain", "Clear", "Snow"]
 Weather = tuple[int, int, int, int, Optional[WeatherStatus]]  # curr_temp, feels_like, min_temp, max_temp
+DisplayedWeather = tuple[int, int, int, Optional[WeatherStatus]]  # rounded curr_temp, min_temp, max_temp
 
 
 class DisplayData:
     def __init__(self):
-        self.subway_arrival_times: list[datetime] = []
+        self.subway_arrival_times: list[int] = []  # unix timestamps
         self.weather: Optional[Weather] = None
 
+        # Validators from the last weather response, to skip unchanged responses
+        self.weather_etag: Optional[str] = None
+        self.weather_last_modified: Optional[str] = None
+
     def subway_arrival_deltas_minutes(self, num: int) -> list[str]:
-        now = now_eastern()
+        # MTA times do not have sub-second precision so just ignore that
+        now = int(time.time())
 
-        future_times = (t for t in self.subway_arrival_times if t >= now)
-        delta_mins = (int((t - now).total_seconds() // 60) for t in future_times)
-        return [str(t) for t in itertools.islice(delta_mins, num)]
+        # Past times are trimmed on each fetch, but some may have gone by since then
+        start = bisect.bisect_left(self.subway_arrival_times, now)
+        return [str((t - now) // 60) for t in self.subway_arrival_times[start:start + num]]
+
+    def displayed_weather(self) -> Optional[DisplayedWeather]:
+        if not self.weather:
+            return None
+
+        curr_temp, _, min_temp, max_temp, weather_status = self.weather
+        return (round(curr_temp), round(min_temp), round(max_temp), weather_status)
 
 
 async def loop(matrix: RGBMatrix):
-    # Fire off tasks that will populate `data`
-    data = DisplayData()
-    asyncio.create_task(populate_subway_times(data))
-    asyncio.create_task(populate_weather(data))
+    # A single session is shared by both polls, with at most one connection per API. The
+    # keepalive just outlasts the subway poll so MTA fetches reuse their socket. Weather polls
+    # are far enough apart that they still reconnect each time.
+    connector = aiohttp.TCPConnector(
+        limit=4,
+        limit_per_host=1,
+        keepalive_timeout=SUBWAY_UPDATE_SECONDS + 15,
+    )
+    # Don't let a hung or trickling API stall updates indefinitely
+    timeout = aiohttp.ClientTimeout(total=15, connect=3, sock_read=10)
+
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        data = DisplayData()
+
+        # Load the initial data concurrently so it's ready for the first render. A failed
+        # fetch leaves its data empty, but a missing API key fails here at startup.
+        await asyncio.gather(_fetch_subway_once(session, data), _fetch_weather_once(session, data))
 
-    # Give the initial data a good chance at being loaded on first render.
-    await asyncio.sleep(2)
+        # Keep `data` up to date while rendering. Failed fetches are handled inside each task, so
+        # the group only fails (cancelling the rest) on an actual bug.
+        async with asyncio.TaskGroup() as tg:
+            tg.create_task(populate_subway_times(session, data))
+            tg.create_task(populate_weather(session, data))
+            tg.create_task(render_loop(matrix, data))
 
-    # Render in the main loop
+
+async def render_loop(matrix: RGBMatrix, data: DisplayData) -> None:
+    # Swap between the same two framebuffers rather than allocating new ones
+    canvas = matrix.CreateFrameCanvas()
+    last_state = None
     while True:
-        render(matrix, data)
+        arrival_minutes = data.subway_arrival_deltas_minutes(3)
+        weather = data.displayed_weather()
+
+        # Nothing to redraw if the last frame was complete and showed the same thing
+        state = (tuple(arrival_minutes), weather)
+        if state != last_state:
+            rendered_all = render(canvas, arrival_minutes, weather)
+            canvas = matrix.SwapOnVSync(canvas)
+            last_state = state if rendered_all else None
+
         await asyncio.sleep(DISPLAY_UPDATE_SECONDS)
 
 
-def render(matrix: RGBMatrix, data: DisplayData) -> bool:
+def render(canvas: "FrameCanvas", arrival_minutes: list[str], weather: Optional[DisplayedWeather]) -> bool:
     rendered_subway = rendered_weather = False
-    canvas = matrix.CreateFrameCanvas()
-
-    font = graphics.Font()
-    font.LoadFont('./fonts/6x10.bdf')
+    # The canvas is reused from a previous frame
+    canvas.Clear()
 
     # Draw subway times
-    if data.subway_arrival_times:
-        arrival_minutes = data.subway_arrival_deltas_minutes(3)
-
+    if arrival_minutes:
         times = ",".join(arrival_minutes)
 
         # Draw graphic for the A train
-        image = Image.open('./img/a_train.png')
-        canvas.SetImage(image.convert('RGB'), offset_x=1, offset_y=1)
+        canvas.SetImage(ICONS['a_train'], offset_x=1, offset_y=1)
 
         # Draw subway times
         # TODO: different colours if the next train is more than 5 minutes away?
-        graphics.DrawText(canvas, font, 12, 8, COLOUR_YELLOW, times)
+        graphics.DrawText(canvas, FONT, 12, 8, COLOUR_YELLOW, times)
 
         rendered_subway = True
 
     # Draw weather
-    if data.weather:
-        curr_temp, _, min_temp, max_temp, weather_status = data.weather
-
-        curr_temp_str = f"{round(curr_temp)}°"
-        min_temp_str = f"{round(min_temp)}°"
-        max_temp_str = f"{round(max_temp)}°"
-
-        x_offset = 12  # room for weather image
-
-        graphics.DrawText(
-            canvas,
-            font,
-            x_offset,
-            18,
-            COLOUR_LIGHT_GRAY,
-            curr_temp_str,
-        )
-
-        # last number is padding between current temp and min/max
-        x_offset += (len(curr_temp_str) * 5) + 6
-
-        graphics.DrawText(
-            canvas,
-            font,
-            x_offset,
-            18,
-            COLOUR_LIGHT_BLUE,
-            min_temp_str,
-        )
-
-        x_offset += (len(min_temp_str) * 5) + 3
-
-        graphics.DrawText(
-            canvas,
-            font,
-            x_offset,
-            18,
-            COLOUR_LIGHT_ORANGE,
-            max_temp_str,
-        )
-
-        if weather_status:
-            try:
-                weather_image = Image.open(f'./img/{weather_status.lower()}.png')
-                canvas.SetImage(weather_image.convert('RGB'), offset_x=1, offset_y=11)
-            except FileNotFoundError:
-                print('No weather icon exists for', weather_status)
+    if weather:
+        row = weather_row_image(*weather)
+        canvas.SetImage(row, offset_x=0, offset_y=WEATHER_ROW_Y)
 
         rendered_weather = True
 
-    matrix.SwapOnVSync(canvas)
-
     # Return a bool to indicate whether we rendered everything expected
     return rendered_subway and rendered_weather
 
 
-async def populate_subway_times(data: DisplayData) -> None:
-    while True:
-        data.subway_arrival_times = await subway_arrival_times()
-        await asyncio.sleep(SUBWAY_UPDATE_SECONDS)
+@functools.lru_cache(maxsize=32)
+def weather_row_image(
+    curr_temp: int,
+    min_temp: int,
+    max_temp: int,
+    weather_status: Optional[WeatherStatus],
+) -> Image.Image:
+    # Composing the icon and temperatures once means each frame is a single `SetImage`
+    row = Image.new('RGB', (COLS, WEATHER_ROW_HEIGHT))
 
+    if weather_status:
+        weather_image = ICONS.get(weather_status.lower())
+        if weather_image:
+            row.paste(weather_image, (1, 1))
+        else:
+            print('No weather icon exists for', weather_status)
 
-async def subway_arrival_times() -> list[datetime]:
-    feed = get_subway_times()
-    trip_updates = [e for e in feed.entity if e.HasField('trip_update')]
+    draw = ImageDraw.Draw(row)
+    x_offset = 12  # room for weather image
 
-    north_stops = []
-    south_stops = []
+    # last number is padding between current temp and min/max
+    x_offset = draw_row_text(draw, x_offset, COLOUR_LIGHT_GRAY, f"{curr_temp}°") + 3
+    x_offset = draw_row_text(draw, x_offset, COLOUR_LIGHT_BLUE, f"{min_temp}°") + 1
+    draw_row_text(draw, x_offset, COLOUR_LIGHT_ORANGE, f"{max_temp}°")
 
-    for entity in trip_updates:
-        if not entity.trip_update.stop_time_update:
-            continue
+    return row
 
-        for stop in entity.trip_update.stop_time_update:
-            if stop.stop_id == HOYT_SCHER_NORTH_STOP:
-                north_stops.append(stop)
-            elif stop.stop_id == HOYT_SCHER_SOUTH_STOP:
-                south_stops.append(stop)  # TODO: currently unused
 
-    north_arrival_times = []
+def draw_row_text(draw: ImageDraw.ImageDraw, x_offset: int, colour: graphics.Color, text: str) -> int:
+    # Returns the x offset just past the drawn text
+    draw.text((x_offset, 0), text, fill=(colour.red, colour.green, colour.blue), font=PIL_FONT)
+    return x_offset + int(PIL_FONT.getlength(text))
 
-    for stop in north_stops:
-        north_arrival_times.append(
-            datetime.utcfromtimestamp(stop.arrival.time).replace(tzinfo=pytz.utc).astimezone(EASTERN_TZ)
-        )
 
-    north_arrival_times.sort()
+async def populate_subway_times(session: aiohttp.ClientSession, data: DisplayData) -> None:
+    while True:
+        await asyncio.sleep(SUBWAY_UPDATE_SECONDS)
+        await _fetch_subway_once(session, data)
 
-    return north_arrival_times
 
+async def _fetch_subway_once(session: aiohttp.ClientSession, data: DisplayData) -> None:
+    try:
+        times = await subway_arrival_times(session)
+    except (aiohttp.ClientError, asyncio.TimeoutError, DecodeError) as e:
+        # Network errors and bad feeds keep the previous times until the next fetch
+        print('Failed to fetch subway times:', repr(e))
+        return
+
+    now = int(time.time())
+    data.subway_arrival_times = [t for t in times if t >= now]
 
-def now_eastern() -> datetime:
-    # MTA times do not have microsecond precision so just ignore that
-    return datetime.utcnow().replace(microsecond=0, tzinfo=pytz.utc).astimezone(EASTERN_TZ)
 
+async def subway_arrival_times(session: aiohttp.ClientSession) -> list[int]:
+    feed = await get_subway_times(session)
 
-def get_subway_times() -> gtfs_realtime_pb2.FeedMessage:
+    north_stops = []
+
+    # Entities without a trip update just yield an empty `stop_time_update`
+    for entity in feed.entity:
+        for stop in entity.trip_update.stop_time_update:
+            if stop.stop_id == HOYT_SCHER_NORTH_STOP:
+                north_stops.append(stop.arrival.time)
+
+    north_stops.sort()
+
+    return north_stops
+
+
+async def get_subway_times(session: aiohttp.ClientSession) -> gtfs_realtime_pb2.FeedMessage:
     api_key = os.getenv('MTA_API_KEY')
     assert api_key, "MTA_API_KEY not set"
 
     # Feed for A,C,E
-    resp = requests.get(
+    async with session.get(
         'https://api-endpoint.mta.info/Dataservice/mtagtfsfeeds/nyct%2Fgtfs-ace',
         headers={'x-api-key': api_key},
-    )
-    resp.raise_for_status()
+    ) as resp:
+        resp.raise_for_status()
+        body = await resp.read()
 
+    # Parse in a worker thread so large feeds don't hold up rendering
     feed = gtfs_realtime_pb2.FeedMessage()
-    feed.ParseFromString(resp.content)
+    await asyncio.to_thread(feed.ParseFromString, body)
 
     return feed
 
 
-async def populate_weather(data: DisplayData) -> None:
+async def populate_weather(session: aiohttp.ClientSession, data: DisplayData) -> None:
     while True:
-        data.weather = await get_weather()
         await asyncio.sleep(WEATHER_UPDATE_SECONDS)
+        await _fetch_weather_once(session, data)
 
 
-async def get_weather() -> Weather:
+async def _fetch_weather_once(session: aiohttp.ClientSession, data: DisplayData) -> None:
+    try:
+        result = await get_weather(session, data.weather_etag, data.weather_last_modified)
+    except (
+        aiohttp.ClientError,
+        asyncio.TimeoutError,
+        ValueError,  # invalid JSON
+        KeyError,
+        AttributeError,
+        TypeError,
+    ) as e:
+        # Network errors and malformed responses keep the previous weather until the next fetch
+        print('Failed to fetch weather:', repr(e))
+        return
+
+    if result is not None:
+        data.weather, data.weather_etag, data.weather_last_modified = result
+
+
+async def get_weather(
+    session: aiohttp.ClientSession,
+    etag: Optional[str],
+    last_modified: Optional[str],
+) -> Optional[tuple[Weather, Optional[str], Optional[str]]]:
+    """Returns the weather with the response's ETag and Last-Modified, or None if unchanged."""
     api_key = os.getenv('OPENWEATHER_API_KEY')
     assert api_key, "OPENWEATHER_API_KEY not set"
 
-    resp = requests.get(
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+
+    async with session.get(
         "https://api.openweathermap.org/data/2.5/weather",
         params={"lat": "40.688986", "lon": "-73.9861586", "appid": api_key, "units": "metric"},
-    )
-    resp.raise_for_status()
+        headers=headers,
+    ) as resp:
+        if resp.status == 304:
+            return None
+
+        resp.raise_for_status()
+        body = await resp.json()
 
-    data = resp.json()
+        etag = resp.headers.get('ETag')
+        last_modified = resp.headers.get('Last-Modified')
 
     # Rain
     status = None
     try:
-        status = data.get('weather')[0]['main']
+        status = body.get('weather')[0]['main']
     except Exception:
         pass
 
-    temp = data.get('main').get('temp')
-    feels_like = data.get('main').get('feels_like')
-    temp_min = data.get('main').get('temp_min')
-    temp_max = data.get('main').get('temp_max')
+    temp = body.get('main').get('temp')
+    feels_like = body.get('main').get('feels_like')
+    temp_min = body.get('main').get('temp_min')
+    temp_max = body.get('main').get('temp_max')
 
-    return (temp, feels_like, temp_min, temp_max, status)
+    return (temp, feels_like, temp_min, temp_max, status), etag, last_modified
 
 
 if __name__ == '__main__':
@@ -252,5 +326,6 @@ if __name__ == '__main__':
         asyncio.run(loop(matrix))
     except KeyboardInterrupt:
         pass
-    # Ensure screen is cleared on shutdown
-    matrix.Clear()
+    finally:
+        # Ensure screen is cleared on shutdown
+        matrix.Clear()